@@ -18,49 +18,157 @@
 
 from __future__ import print_function
 
+import json
 import os
 from os.path import dirname, abspath, join as joinpath
+from stat import S_ISDIR
 import subprocess
 import sys
+import tempfile
 
 import errno
-from setuptools import setup, find_packages as setuptools_find_packages
+from setuptools import setup
+
+try:
+    from os import scandir
+except ImportError:
+    # Python 2
+    scandir = None
+
+source_root = dirname(abspath(__file__))
 
 base_version = "0.1"
 base_project = "ccs-twistedextensions"
 
+git_revision_command = ("git", "rev-parse", "HEAD", "--abbrev-ref", "HEAD")
+git_tag_command = ("git", "describe", "--exact-match", "HEAD")
+
 
 #
 # Utilities
 #
+def listdir(path, follow_symlinks=False):
+    """
+    List the entries in a directory as C{(name, path, isdir)} tuples.
+
+    Where L{os.scandir} is available the directory check uses the entry type
+    returned by C{readdir}, so no additional C{stat} is needed per entry
+    (other than for symbolic links, if C{follow_symlinks} is set). Symbolic
+    links to directories are only treated as directories if
+    C{follow_symlinks} is set.
+    """
+    if scandir is None:
+        # One stat call per entry: lstat doesn't follow symbolic links
+        isdir = os.stat if follow_symlinks else os.lstat
+        for name in os.listdir(path):
+            child = joinpath(path, name)
+            try:
+                child_isdir = S_ISDIR(isdir(child).st_mode)
+            except OSError:
+                child_isdir = False
+            yield name, child, child_isdir
+    else:
+        for entry in scandir(path):
+            yield (
+                entry.name, entry.path,
+                entry.is_dir(follow_symlinks=follow_symlinks),
+            )
+
+
+# Directories that are never packages, and which can be large
+pruned_directories = frozenset((
+    "build",
+    "dist",
+    "__pycache__",
+    "node_modules",
+))
+
+
+def is_package(entry):
+    name, path, isdir = entry
+    return (
+        isdir and
+        not name.startswith(".") and
+        name not in pruned_directories and
+        not name.endswith(".egg-info") and
+        os.path.isfile(joinpath(path, "__init__.py"))
+    )
+
+
+def find_subpackages(root):
+    """
+    Find all the packages below C{root}, as dotted names relative to C{root}.
+
+    Directories that are not packages are not descended into. Symbolic links
+    to directories are followed, as L{setuptools.find_packages} does.
+    """
+    packages = []
+    for name, path, _ignore_isdir in filter(
+        is_package, listdir(root, follow_symlinks=True)
+    ):
+        packages.append(name)
+        packages.extend([
+            "{}.{}".format(name, subpkg)
+            for subpkg in find_subpackages(path)
+        ])
+    return packages
+
+
 def find_packages():
     modules = [
         "twisted.plugins",
     ]
 
-    def is_package(path):
-        return (
-            os.path.isdir(path) and
-            os.path.isfile(os.path.join(path, "__init__.py"))
-        )
-
-    for pkg in filter(is_package, os.listdir(".")):
+    for pkg, path, _ignore_isdir in filter(is_package, listdir(".")):
         modules.extend([pkg, ] + [
             "{}.{}".format(pkg, subpkg)
-            for subpkg in setuptools_find_packages(pkg)
+            for subpkg in find_subpackages(path)
         ])
     return modules
 
 
+def git_output(wc_path, command):
+    """
+    Run a GIT command in a working copy and return its output. Error output
+    is discarded rather than mixed in with the result, and there is no need
+    to close other file descriptors in the child.
+    """
+    with open(os.devnull, "wb") as devnull:
+        return subprocess.check_output(
+            command, stderr=devnull, close_fds=False, cwd=wc_path,
+        ).decode("utf-8")
+
+
+def git_has_tags(wc_path):
+    """
+    Determine whether a GIT working copy has any tags at all, without running
+    git. If that can't be determined (e.g. in a worktree, where .git is a
+    file), assume that it does.
+    """
+    git_dir = joinpath(wc_path, ".git")
+    if not os.path.isdir(git_dir):
+        return True
+
+    try:
+        if os.listdir(joinpath(git_dir, "refs", "tags")):
+            return True
+    except OSError:
+        pass
+
+    try:
+        with open(joinpath(git_dir, "packed-refs")) as f:
+            return any(" refs/tags/" in line for line in f)
+    except IOError:
+        return False
+
+
 def git_info(wc_path):
     """
     Look up info on a GIT working copy.
     """
+    # A single rev-parse gives us both the revision and the branch name
     try:
-        branch = subprocess.check_output(
-            ["git", "rev-parse", "--abbrev-ref", "HEAD"],
-            stderr=subprocess.STDOUT,
-        ).decode("utf-8")
+        revision_branch = git_output(wc_path, git_revision_command)
     except OSError as e:
         if e.errno == errno.ENOENT:
             return None
@@ -68,105 +176,294 @@ def git_info(wc_path):
     except subprocess.CalledProcessError:
         return None
 
-    branch = branch.strip()
-
     try:
-        revision = subprocess.check_output(
-            ["git", "rev-parse", "--verify", "HEAD"],
-            stderr=subprocess.STDOUT,
-        ).decode("utf-8")
-    except OSError as e:
-        if e.errno == errno.ENOENT:
-            return None
-        raise
-    except subprocess.CalledProcessError:
+        revision, branch = revision_branch.split()
+    except ValueError:
         return None
 
-    revision = revision.strip()
+    # Clones without any tags (typical of shallow CI checkouts) can't be on a
+    # tagged release, so don't bother asking git
+    if not git_has_tags(wc_path):
+        tag = None
+    else:
+        tag = git_tag(wc_path)
+
+    return dict(
+        project=base_project,
+        branch=branch,
+        revision=revision,
+        tag=tag,
+    )
+
+
+def git_tag(wc_path):
+    """
+    Look up the tag on the HEAD of a GIT working copy.
 
+    @return: the tag, or C{None} if HEAD is not tagged.
+    """
     try:
-        tags = subprocess.check_output(
-            ["git", "describe", "--exact-match", "HEAD"],
-            stderr=subprocess.STDOUT,
-        ).decode("utf-8")
+        tags = git_output(wc_path, git_tag_command)
     except OSError as e:
         if e.errno == errno.ENOENT:
             return None
         raise
     except subprocess.CalledProcessError:
-        tag = None
+        return None
     else:
         tags = tags.strip().split()
-        tag = tags[0]
+        return tags[0]
 
-    return dict(
-        project=base_project,
-        branch=branch,
-        revision=revision,
-        tag=tag,
-    )
+
+def write_if_changed(filename, content):
+    """
+    Atomically replace the contents of a file, but leave it (and its
+    modification time) alone if the contents would not change.
+    """
+    try:
+        with open(filename) as f:
+            if f.read() == content:
+                return
+        mode = os.stat(filename).st_mode & 0o777
+    except (IOError, OSError):
+        mode = 0o644
+
+    with tempfile.NamedTemporaryFile(
+        "w", dir=dirname(filename), delete=False
+    ) as f:
+        f.write(content)
+    try:
+        os.chmod(f.name, mode)
+        getattr(os, "replace", os.rename)(f.name, filename)
+    except OSError:
+        os.remove(f.name)
+        raise
+
+
+def git_stamp(wc_path):
+    """
+    Compute a stamp for a GIT working copy that changes whenever the result of
+    L{git_version} might: C{base_version}, the contents of HEAD, the revision
+    the branch it names points to, and the tags. Ref contents are used rather
+    than modification times, since HEAD may move several times within the
+    resolution of the file system's timestamps.
+
+    @return: the stamp, or C{None} if it can't be determined (e.g. in a
+        worktree, where .git is a file).
+    @rtype: L{list} or L{NoneType}
+    """
+    git_dir = joinpath(wc_path, ".git")
+    try:
+        with open(joinpath(git_dir, "HEAD")) as f:
+            head = f.read().strip()
+    except IOError:
+        return None
+
+    try:
+        with open(joinpath(git_dir, "packed-refs")) as f:
+            packed_refs = f.read()
+    except IOError:
+        packed_refs = ""
+
+    stamp = [base_version, head]
+
+    # The revision HEAD's branch points to - from the loose ref if there is
+    # one, otherwise from packed-refs
+    if head.startswith("ref: "):
+        ref = head[len("ref: "):]
+        try:
+            with open(joinpath(git_dir, ref)) as f:
+                stamp.append(f.read().strip())
+        except IOError:
+            stamp.append(next((
+                line.split(" ", 1)[0]
+                for line in packed_refs.splitlines()
+                if line.endswith(" " + ref)
+            ), None))
+
+    # Loose tags, plus packed-refs for packed tags
+    tags_dir = joinpath(git_dir, "refs", "tags")
+    for dirpath, dirnames, filenames in os.walk(tags_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            try:
+                with open(joinpath(dirpath, filename)) as f:
+                    stamp.append([
+                        os.path.relpath(joinpath(dirpath, filename), tags_dir),
+                        f.read().strip(),
+                    ])
+            except IOError:
+                pass
+    stamp.append(packed_refs)
+
+    return stamp
+
+
+def read_version_cache(filename, stamp):
+    """
+    Read a cached version number.
+
+    @return: the cached version, or C{None} if there is no cached version
+        for C{stamp}.
+    """
+    try:
+        with open(filename) as f:
+            cache = json.load(f)
+        if cache["stamp"] == stamp:
+            return str(cache["version"])
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def write_version_cache(filename, stamp, version_string):
+    """
+    Cache a version number for a given stamp.
+    """
+    try:
+        with open(filename, "w") as f:
+            json.dump(dict(stamp=stamp, version=version_string), f)
+    except IOError:
+        pass
 
 
 def version():
     """
     Compute the version number.
+
+    The result is cached in C{.version_cache} at the top of the source tree
+    (ignored by GIT), so calling this writes that file whenever the cached
+    version is missing or out of date - including for commands such as
+    C{setup.py --version}.
+    """
+    unknown_version = "{}a1+unknown".format(base_version)
+
+    # Don't bother running git at all for an exported source tree (.git is a
+    # file rather than a directory in a worktree)
+    if not os.path.exists(joinpath(source_root, ".git")):
+        return unknown_version
+
+    # Re-use the last computed version if nothing relevant in the working
+    # copy has changed since
+    stamp = git_stamp(source_root)
+    if stamp is None:
+        return git_version(source_root) or unknown_version
+
+    cache_filename = joinpath(source_root, ".version_cache")
+    version_string = read_version_cache(cache_filename, stamp)
+    if version_string is None:
+        version_string = git_version(source_root)
+        if version_string is None:
+            # Don't cache the failure: git may be available next time
+            return unknown_version
+        write_version_cache(cache_filename, stamp, version_string)
+
+    return version_string
+
+
+def tag_version(info):
+    """
+    Version number for a tagged release of this project, or C{None} if HEAD
+    does not have one of our tags.
+    """
+    if not info["tag"]:
+        return None
+
+    project_version = info["tag"]
+    try:
+        project, version = project_version.split("-")
+    except ValueError:
+        project = project_version
+        version = "Unknown"
+
+    # Only process tags with our project name prefix
+    if project != project_name:
+        return None
+
+    assert version == base_version, (
+        "Tagged version {!r} != {!r}".format(version, base_version)
+    )
+    # This is a correctly tagged release of this project.
+    return base_version
+
+
+def release_branch_version(info):
     """
-    source_root = dirname(abspath(__file__))
+    Version number for a release branch of this project, or C{None} if this
+    is not a release branch.
+    """
+    if not info["branch"].startswith("release/"):
+        return None
+
+    project_version = info["branch"][len("release/"):]
+    project, version, dev = project_version.split("-")
+    assert project == project_name, (
+        "Branched project {!r} != {!r}".format(project, project_name)
+    )
+    assert version == base_version, (
+        "Branched version {!r} != {!r}".format(version, base_version)
+    )
+    assert dev == "dev", (
+        "Branch name doesn't end in -dev: {!r}".format(info["branch"])
+    )
+    # This is a release branch of this project.
+    # Designate this as beta2, dev version based on git revision.
+    return "{}b2.dev0+{}".format(base_version, info["revision"])
+
 
+def master_version(info):
+    """
+    Version number for master, or C{None} if this is not master.
+    """
+    if info["branch"] != "master":
+        return None
+
+    # This is master.
+    # Designate this as beta1, dev version based on git revision.
+    return "{}b1.dev0+{}".format(base_version, info["revision"])
+
+
+def other_version(info):
+    """
+    Version number for some unknown branch or tag.
+    """
+    return "{}a1.dev0+{}.{}".format(
+        base_version,
+        info["revision"],
+        info["branch"].replace("/", ".").replace("-", ".").lower(),
+    )
+
+
+# Each of these is tried in turn until one returns a version number
+version_handlers = (
+    tag_version,
+    release_branch_version,
+    master_version,
+    other_version,
+)
+
+
+def git_version(source_root):
+    """
+    Compute the version number from GIT.
+
+    @return: the version number, or C{None} if GIT info is not available.
+    """
     info = git_info(source_root)
 
     if info is None:
         # We don't have GIT info...
-        return "{}a1+unknown".format(base_version)
+        return None
 
     assert info["project"] == base_project, (
         "GIT project {!r} != {!r}"
         .format(info["project"], base_project)
     )
 
-    if info["tag"]:
-        project_version = info["tag"]
-        try:
-            project, version = project_version.split("-")
-        except ValueError:
-            project = project_version
-            version = "Unknown"
-
-        # Only process tags with our project name prefix
-        if project == project_name:
-            assert version == base_version, (
-                "Tagged version {!r} != {!r}".format(version, base_version)
-            )
-            # This is a correctly tagged release of this project.
-            return base_version
-
-    if info["branch"].startswith("release/"):
-        project_version = info["branch"][len("release/"):]
-        project, version, dev = project_version.split("-")
-        assert project == project_name, (
-            "Branched project {!r} != {!r}".format(project, project_name)
-        )
-        assert version == base_version, (
-            "Branched version {!r} != {!r}".format(version, base_version)
-        )
-        assert dev == "dev", (
-            "Branch name doesn't end in -dev: {!r}".format(info["branch"])
-        )
-        # This is a release branch of this project.
-        # Designate this as beta2, dev version based on git revision.
-        return "{}b2.dev0+{}".format(base_version, info["revision"])
-
-    if info["branch"] == "master":
-        # This is master.
-        # Designate this as beta1, dev version based on git revision.
-        return "{}b1.dev0+{}".format(base_version, info["revision"])
-
-    # This is some unknown branch or tag...
-    return "{}a1.dev0+{}.{}".format(
-        base_version,
-        info["revision"],
-        info["branch"].replace("/", ".").replace("-", ".").lower(),
-    )
+    for handler in version_handlers:
+        version_string = handler(info)
+        if version_string is not None:
+            return version_string
 
 
 #
@@ -177,7 +474,11 @@ project_name = "twext"
 
 description = "Extensions to Twisted"
 
-long_description = open(joinpath(dirname(__file__), "README.rst")).read()
+
+def long_description():
+    with open(joinpath(source_root, "README.rst")) as f:
+        return f.read()
+
 
 url = "https://github.com/apple/ccs-twistedextensions"
 
@@ -243,16 +544,31 @@ if "ORACLE_HOME" in os.environ:
 # Set up Extension modules that need to be built
 #
 
-extensions = []
+# Importing the cffi-based modules compiles them, so only do that for
+# commands that will actually build extensions.
+build_commands = frozenset((
+    "build",
+    "build_ext",
+    "install",
+    "bdist_egg",
+    "bdist_wheel",
+    "develop",
+))
 
-if sys.platform == "darwin":
-    try:
-        from twext.python import launchd
-        extensions.append(launchd.ffi.verifier.get_extension())
-        from twext.python import sacl
-        extensions.append(sacl.ffi.verifier.get_extension())
-    except ImportError:
-        pass
+
+def extensions():
+    modules = []
+
+    if sys.platform == "darwin" and build_commands.intersection(sys.argv[1:]):
+        try:
+            from twext.python import launchd
+            modules.append(launchd.ffi.verifier.get_extension())
+            from twext.python import sacl
+            modules.append(sacl.ffi.verifier.get_extension())
+        except ImportError:
+            pass
+
+    return modules
 
 
 #
@@ -262,23 +578,16 @@ if sys.platform == "darwin":
 def doSetup():
     # Write version file
     version_string = version()
-    version_filename = joinpath(
-        dirname(__file__), "twext", "version.py"
+    version_filename = joinpath(source_root, "twext", "version.py")
+    write_if_changed(
+        version_filename, 'version = "{0}"\n\n'.format(version_string)
     )
-    version_file = open(version_filename, "w")
-
-    try:
-        version_file.write(
-            'version = "{0}"\n\n'.format(version_string)
-        )
-    finally:
-        version_file.close()
 
     setup(
         name="twextpy",
         version=version_string,
         description=description,
-        long_description=long_description,
+        long_description=long_description(),
         url=url,
         classifiers=classifiers,
         author=author,
@@ -290,7 +599,7 @@ def doSetup():
         entry_points=entry_points,
         scripts=[],
         data_files=[],
-        ext_modules=extensions,
+        ext_modules=extensions(),
         py_modules=[],
         setup_requires=setup_requirements,
         install_requires=install_requirements,
@@ -590,6 +590,22 @@ class Record(object):
         ).on(transaction)
         returnValue(rows[0][0])
 
+    @classmethod
+    @inlineCallbacks
+    def exists(cls, transaction, where=None):
+        """
+        Determine whether any rows in the table that corresponds to C{cls} match
+        C{where}. Only one column of at most one row is fetched, so this is cheaper
+        than L{query} or L{count} when only the presence of a row matters.
+        """
+        rows = yield Select(
+            list(cls.table)[:1],
+            From=cls.table,
+            Where=where,
+            Limit=1,
+        ).on(transaction)
+        returnValue(len(rows) != 0)
+
     @classmethod
     def updatesome(cls, transaction, where, **kw):
         """
@@ -656,7 +672,7 @@ class Record(object):
 
     @classmethod
     @inlineCallbacks
-    def _rowsFromQuery(cls, transaction, qry, rozrc):
+    def _rowsFromQuery(cls, transaction, qry, rozrc, **kw):
         """
         Execute the given query, and transform its results into instances of
         C{cls}.
@@ -669,10 +685,12 @@ class Record(object):
 
         @param rozrc: The C{raiseOnZeroRowCount} argument.
 
+        @param kw: values for any L{Parameter}s in C{qry}.
+
         @return: a L{Deferred} that succeeds with a C{list} of instances of
             C{cls} or fails with an exception produced by C{rozrc}.
         """
-        rows = yield qry.on(transaction, raiseOnZeroRowCount=rozrc)
+        rows = yield qry.on(transaction, raiseOnZeroRowCount=rozrc, **kw)
         selves = []
         names = [cls.__colmap__[column] for column in list(cls.table)]
         for row in rows:
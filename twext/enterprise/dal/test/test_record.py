@@ -357,6 +357,21 @@ class TestCRUD(TestCase):
             len(data)
         )
 
+    @inlineCallbacks
+    def test_exists(self):
+        """
+        L{Record.exists} will return whether any records match
+        """
+        txn = self.pool.connection()
+        self.assertFalse((yield TestRecord.exists(txn)))
+        data = [(123, u"one"), (456, u"four")]
+        for beta, gamma in data:
+            yield txn.execSQL("insert into ALPHA values (:1, :2)",
+                              [beta, gamma])
+        self.assertTrue((yield TestRecord.exists(txn)))
+        self.assertTrue((yield TestRecord.exists(txn, TestRecord.beta == 456)))
+        self.assertFalse((yield TestRecord.exists(txn, TestRecord.beta == 789)))
+
     @inlineCallbacks
     def test_updatesome(self):
         """
@@ -18,17 +18,24 @@
 from twext.enterprise.dal.model import Sequence
 from twext.enterprise.dal.model import Table, Schema, SQLType
 from twext.enterprise.dal.record import Record, fromTable, NoSuchRecord
-from twext.enterprise.dal.syntax import SchemaSyntax, Call, Count, Case, Constant, Sum
+from twext.enterprise.dal.syntax import SchemaSyntax, Call, Count, Case, Constant, Sum, \
+    Parameter, Update
 from twext.enterprise.ienterprise import ORACLE_DIALECT
 from twext.enterprise.jobs.utils import inTransaction, astimestamp
 from twext.python.log import Logger
 
-from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
+from twisted.internet.task import deferLater
+from twisted.logger import LogLevel
 from twisted.protocols.amp import Argument
 from twisted.python.failure import Failure
 
 from datetime import datetime, timedelta
-from collections import namedtuple
+from collections import deque
+from functools import partial
+from math import ceil, log as logarithm
+import random
+import struct
 import time
 
 log = Logger()
@@ -105,11 +112,137 @@ class JobRunningError(Exception):
     pass
 
 
+@inlineCallbacks
+def _pollUntil(txnCreator, reactor, timeout, predicate, interval=0.1, maxInterval=2.0):
+    """
+    Repeatedly run a test in its own transaction until it succeeds or a timeout
+    expires. The interval between attempts doubles each time (up to C{maxInterval})
+    to avoid hammering the database when waiting for a long time.
+
+    @param txnCreator: a 0-arg callable that returns an L{IAsyncTransaction}
+    @param reactor: the reactor to use for delays and to measure the timeout
+    @param timeout: how long to wait in seconds
+    @type timeout: L{float}
+    @param predicate: a 1-arg callable taking an L{IAsyncTransaction} and returning
+        a L{Deferred} that fires with L{True} when the wait is over.
+    @param interval: initial delay between attempts in seconds
+    @type interval: L{float}
+    @param maxInterval: maximum delay between attempts in seconds
+    @type maxInterval: L{float}
+
+    @return: a L{Deferred} that fires with L{True} if C{predicate} succeeded, or
+        L{False} if the timeout expired.
+    """
+    t = reactor.seconds()
+    while True:
+        done = yield inTransaction(txnCreator, predicate)
+        if done:
+            returnValue(True)
+        if reactor.seconds() - t > timeout:
+            returnValue(False)
+        yield deferLater(reactor, interval, lambda: None)
+        interval = min(interval * 2, maxInterval)
+
+
+def _elapsed(t):
+    """
+    Format the time elapsed since C{t} in milliseconds, for logging.
+    """
+    return "{:.3f}".format(1000 * (time.time() - t))
+
+
+def _overdue(t, notBefore):
+    """
+    Format how late, in milliseconds, a job with C{notBefore} started at C{t},
+    for logging.
+    """
+    return "{:.0f}".format(1000 * (t - astimestamp(notBefore)))
+
+
+@inlineCallbacks
+def _markJobFailed(txn, jobClass, jobDescriptor, t, locked, delay, failed):
+    """
+    Record a failure to run a job, if the job still exists. See
+    L{_failedJobCleanUp}. The job only needs to be loaded when the default
+    back-off delay, which depends on its failure count, is to be used.
+    """
+    try:
+        if delay is None:
+            job = yield jobClass.load(txn, jobDescriptor.jobID)
+            failed = job.failed
+            yield job.failedToRun(locked=locked)
+        else:
+            yield jobClass.bumpFailure(txn, jobDescriptor.jobID, delay, locked=locked)
+    except NoSuchRecord:
+        if log.isEnabledFor(LogLevel.debug):
+            log.debug(
+                "JobItem: {workType} {jobid} disappeared t={tm}",
+                workType=jobDescriptor.workType,
+                jobid=jobDescriptor.jobID,
+                tm=_elapsed(t),
+            )
+    else:
+        if log.isEnabledFor(LogLevel.debug):
+            log.debug(
+                "JobItem: {workType} {jobid} marked as failed {count} t={tm}",
+                workType=jobDescriptor.workType,
+                jobid=jobDescriptor.jobID,
+                count=failed + 1,
+                tm=_elapsed(t),
+            )
+
+
+def _failedJobCleanUp(jobClass, txnFactory, jobDescriptor, t, locked, delay=None, failed=0):
+    """
+    Reschedule a job that failed to run, in a new transaction. Used as a
+    post-abort hook by L{JobItem.ultimatelyPerform}, which binds the arguments
+    with L{partial}.
+
+    @param jobClass: the L{JobItem} class the job was loaded with
+    @param txnFactory: a 0- or 1-argument callable that creates an
+        L{IAsyncTransaction}
+    @param jobDescriptor: the job that failed
+    @type jobDescriptor: L{JobDescriptor}
+    @param t: the time at which the job started to run
+    @type t: L{float}
+    @param locked: whether the job failed because it was already running
+    @type locked: L{bool}
+    @param delay: seconds before the job is run again, or L{None} for the
+        default back-off
+    @type delay: L{int} or L{None}
+    @param failed: the failure count of the job when it was run, for logging
+        when C{delay} is given (otherwise the job is loaded)
+    @type failed: L{int}
+    """
+    return inTransaction(
+        txnFactory, _markJobFailed, "ultimatelyPerform._failureCleanUp",
+        jobClass=jobClass, jobDescriptor=jobDescriptor, t=t, locked=locked, delay=delay,
+        failed=failed,
+    )
+
+
 # Priority for work - used to order work items in the job queue
 JOB_PRIORITY_LOW = 0
 JOB_PRIORITY_MEDIUM = 1
 JOB_PRIORITY_HIGH = 2
 
+# The registered L{WorkItem} sub-classes, populated by L{JobItem.registerWorkType}
+# as each concrete L{WorkItem} class is defined
+_workTypes = []
+_workTypeMap = {}
+
+
+def workItemForType(workType):
+    """
+    Return the L{WorkItem} sub-class for a type of work.
+
+    @param workType: the name of the L{WorkItem}'s table
+    @type workType: L{str}
+
+    @raise KeyError: if no L{WorkItem} sub-class is registered for C{workType}
+    """
+    return _workTypeMap[workType]
+
 
 class JobItem(Record, fromTable(JobInfoSchema.JOB)):
     """
@@ -146,11 +279,20 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
     OVERDUE value of that row if the work takes a long time to complete.
     """
 
-    _workTypes = None
-    _workTypeMap = None
+    # Populated by L{registerWorkType} as each concrete L{WorkItem} class is defined
+    _lifoWorkTypes = []
+
+    # Cache of the L{nextjobs} queries - see L{_nextjobsQuery}
+    _nextjobsQueries = {}
 
     lockRescheduleInterval = 60     # When a job can't run because of a lock, reschedule it this number of seconds in the future
     failureRescheduleInterval = 60  # When a job fails, reschedule it this number of seconds in the future
+    maxRescheduleInterval = 3600    # Upper limit on the back-off applied to repeated failures
+    backoffBase = 2                 # Each failure multiplies the reschedule interval by this amount
+    prefetchBatch = 1               # Number of jobs L{nextjob} fetches (and locks) in one query - extras are returned by later calls in the same transaction
+    starvationThreshold = None      # When more jobs than this are ready to run, L{nextjob} takes the newest jobs of C{lifoEligible} work types first (None to disable)
+    starvationCheckInterval = 5     # Minimum number of seconds between the L{starved} checks made by L{nextjob}
+    _starvationCheck = (None, False)    # Time and result of the last L{starved} check made by L{nextjob}
 
     def descriptor(self):
         return JobDescriptor(self.jobID, self.weight, self.workType)
@@ -183,11 +325,12 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
         """
         return self.update(overdue=self.overdue + timedelta(seconds=bump))
 
+    @inlineCallbacks
     def failedToRun(self, locked=False, delay=None):
         """
         The attempt to run the job failed. Leave it in the queue, but mark it
         as unassigned, bump the failure count and set to run at some point in
-        the future.
+        the future. Nothing happens if the job no longer exists.
 
         @param lock: indicates if the failure was due to a lock timeout.
         @type lock: L{bool}
@@ -196,19 +339,83 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
         @type delay: L{int}
         """
 
-        # notBefore is set to the chosen interval multiplied by the failure count, which
-        # results in an incremental backoff for failures
+        # notBefore is set to the chosen interval with an exponential, jittered backoff
+        # based on the failure count
         if delay is None:
-            delay = self.lockRescheduleInterval if locked else self.failureRescheduleInterval
-            delay *= (self.failed + 1)
-        return self.update(
+            delay = self.backoffDelay(self.lockRescheduleInterval if locked else self.failureRescheduleInterval)
+        notBefore = yield self.bumpFailure(
+            self.transaction, self.jobID, delay, locked=locked, raiseOnZeroRowCount=None,
+        )
+
+        # Keep this record in sync with the row, as L{Record.update} does
+        self.__dict__.update(
             isAssigned=0,
             assigned=None,
             overdue=None,
             failed=self.failed + (0 if locked else 1),
-            notBefore=datetime.utcnow() + timedelta(seconds=delay)
+            notBefore=notBefore,
         )
 
+    @classmethod
+    def bumpFailure(cls, txn, jobID, delay, locked=False, raiseOnZeroRowCount=NoSuchRecord):
+        """
+        Mark a job as unassigned, bump its failure count and set it to run again
+        after C{delay}. The failure count is incremented by the database, rather than
+        written back from a loaded L{JobItem}, so a concurrent update of the row (e.g.
+        by the overdue check) is not lost and the job does not need to be loaded first.
+
+        @param txn: the transaction to use
+        @type txn: L{IAsyncTransaction}
+        @param jobID: the job to update
+        @type jobID: L{int}
+        @param delay: how long, in seconds, before the job is run again
+        @type delay: L{float}
+        @param locked: indicates if the failure was due to a lock timeout, in which
+            case the failure count is not bumped.
+        @type locked: L{bool}
+        @param raiseOnZeroRowCount: a 0-argument callable returning the exception to
+            fail with if the job no longer exists, or L{None} to ignore that
+        @type raiseOnZeroRowCount: L{callable}
+
+        @return: a L{Deferred} that fires with the job's new C{notBefore} when it has
+            been updated, or fails with L{NoSuchRecord} if the job no longer exists.
+        @rtype: L{Deferred}
+        """
+        notBefore = datetime.utcnow() + timedelta(seconds=delay)
+        colmap = {
+            cls.isAssigned: 0,
+            cls.assigned: None,
+            cls.overdue: None,
+            cls.notBefore: notBefore,
+        }
+        if not locked:
+            colmap[cls.failed] = cls.failed + 1
+        d = Update(colmap, Where=(cls.jobID == jobID)).on(txn, raiseOnZeroRowCount=raiseOnZeroRowCount)
+        d.addCallback(lambda _ignore: notBefore)
+        return d
+
+    def backoffDelay(self, interval):
+        """
+        Determine how long to wait before re-running this job after a failure. The
+        delay grows exponentially with the failure count, up to L{maxRescheduleInterval},
+        and is randomly reduced by up to half so that jobs which failed together (e.g.
+        due to a database outage) do not all get retried at the same time.
+
+        @param interval: the delay in seconds for the first failure
+        @type interval: L{int}
+
+        @return: the delay in seconds
+        @rtype: L{float}
+        """
+        # Cap the exponent at the point the maximum is reached, as a float interval
+        # times a huge power overflows
+        failed = self.failed
+        if interval > 0 and self.backoffBase > 1:
+            limit = ceil(logarithm(float(self.maxRescheduleInterval) / interval, self.backoffBase))
+            failed = min(failed, max(0, int(limit)))
+        delay = min(self.maxRescheduleInterval, interval * (self.backoffBase ** failed))
+        return delay * (0.5 + random.random() * 0.5)
+
     def pauseIt(self, pause=False):
         """
         Pause the L{JobItem} leaving all other attributes the same. The job processing loop
@@ -242,88 +449,69 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
         """
 
         t = time.time()
+        debug = log.isEnabledFor(LogLevel.debug)
 
-        def _tm():
-            return "{:.3f}".format(1000 * (time.time() - t))
-
-        def _overtm(nb):
-            return "{:.0f}".format(1000 * (t - astimestamp(nb)))
-
-        # Failed job clean-up
-        def _failureCleanUp(delay=None):
-            @inlineCallbacks
-            def _cleanUp2(txn2):
-                try:
-                    job = yield cls.load(txn2, jobDescriptor.jobID)
-                except NoSuchRecord:
-                    log.debug(
-                        "JobItem: {workType} {jobid} disappeared t={tm}",
-                        workType=jobDescriptor.workType,
-                        jobid=jobDescriptor.jobID,
-                        tm=_tm(),
-                    )
-                else:
-                    log.debug(
-                        "JobItem: {workType} {jobid} marking as failed {count} t={tm}",
-                        workType=jobDescriptor.workType,
-                        jobid=jobDescriptor.jobID,
-                        count=job.failed + 1,
-                        tm=_tm(),
-                    )
-                    yield job.failedToRun(locked=isinstance(e, JobRunningError), delay=delay)
-            return inTransaction(txnFactory, _cleanUp2, "ultimatelyPerform._failureCleanUp")
-
-        log.debug("JobItem: {workType} {jobid} starting to run", workType=jobDescriptor.workType, jobid=jobDescriptor.jobID)
+        if debug:
+            log.debug("JobItem: {workType} {jobid} starting to run", workType=jobDescriptor.workType, jobid=jobDescriptor.jobID)
         txn = txnFactory(label="ultimatelyPerform: {workType} {jobid}".format(workType=jobDescriptor.workType, jobid=jobDescriptor.jobID))
         try:
             job = yield cls.load(txn, jobDescriptor.jobID)
             if hasattr(txn, "_label"):
                 txn._label = "{} <{}>".format(txn._label, job.workType)
-            log.debug(
-                "JobItem: {workType} {jobid} loaded {work} t={tm}",
-                workType=jobDescriptor.workType,
-                jobid=jobDescriptor.jobID,
-                work=job.workType,
-                tm=_tm(),
-            )
+            if debug:
+                log.debug(
+                    "JobItem: {workType} {jobid} loaded {work} t={tm}",
+                    workType=jobDescriptor.workType,
+                    jobid=jobDescriptor.jobID,
+                    work=job.workType,
+                    tm=_elapsed(t),
+                )
             yield job.run()
 
         except NoSuchRecord:
             # The record has already been removed
             yield txn.commit()
-            log.debug(
-                "JobItem: {workType} {jobid} already removed t={tm}",
-                workType=jobDescriptor.workType,
-                jobid=jobDescriptor.jobID,
-                tm=_tm(),
-            )
+            if debug:
+                log.debug(
+                    "JobItem: {workType} {jobid} already removed t={tm}",
+                    workType=jobDescriptor.workType,
+                    jobid=jobDescriptor.jobID,
+                    tm=_elapsed(t),
+                )
 
         except JobTemporaryError as e:
 
-            # Temporary failure delay with back-off
-            def _temporaryFailure():
-                return _failureCleanUp(delay=e.delay * (job.failed + 1))
-            log.debug(
-                "JobItem: {workType} {jobid} {desc} t={tm}",
-                workType=jobDescriptor.workType,
-                jobid=jobDescriptor.jobID,
-                desc="temporary failure #{}".format(job.failed + 1),
-                tm=_tm(),
-            )
-            txn.postAbort(_temporaryFailure)
+            if debug:
+                log.debug(
+                    "JobItem: {workType} {jobid} {desc} t={tm}",
+                    workType=jobDescriptor.workType,
+                    jobid=jobDescriptor.jobID,
+                    desc="temporary failure #{}".format(job.failed + 1),
+                    tm=_elapsed(t),
+                )
+            # Temporary failure delay with back-off - but never less than the delay
+            # the job asked for
+            txn.postAbort(partial(
+                _failedJobCleanUp, cls, txnFactory, jobDescriptor, t, False,
+                max(e.delay, job.backoffDelay(e.delay)), job.failed,
+            ))
             yield txn.abort()
 
         except (JobFailedError, JobRunningError) as e:
 
             # Permanent failure
-            log.debug(
-                "JobItem: {workType} {jobid} {desc} t={tm}",
-                workType=jobDescriptor.workType,
-                jobid=jobDescriptor.jobID,
-                desc="failed" if isinstance(e, JobFailedError) else "locked",
-                tm=_tm(),
-            )
-            txn.postAbort(_failureCleanUp)
+            if debug:
+                log.debug(
+                    "JobItem: {workType} {jobid} {desc} t={tm}",
+                    workType=jobDescriptor.workType,
+                    jobid=jobDescriptor.jobID,
+                    desc="failed" if isinstance(e, JobFailedError) else "locked",
+                    tm=_elapsed(t),
+                )
+            txn.postAbort(partial(
+                _failedJobCleanUp, cls, txnFactory, jobDescriptor, t,
+                isinstance(e, JobRunningError),
+            ))
             yield txn.abort()
 
         except:
@@ -332,7 +520,7 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
                 "JobItem: {workType} {jobid} exception t={tm} {exc}",
                 workType=jobDescriptor.workType,
                 jobid=jobDescriptor.jobID,
-                tm=_tm(),
+                tm=_elapsed(t),
                 exc=f,
             )
             yield txn.abort()
@@ -340,13 +528,14 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
 
         else:
             yield txn.commit()
-            log.debug(
-                "JobItem: {workType} {jobid} completed t={tm} over={over}",
-                workType=jobDescriptor.workType,
-                jobid=jobDescriptor.jobID,
-                tm=_tm(),
-                over=_overtm(job.notBefore),
-            )
+            if debug:
+                log.debug(
+                    "JobItem: {workType} {jobid} completed t={tm} over={over}",
+                    workType=jobDescriptor.workType,
+                    jobid=jobDescriptor.jobID,
+                    tm=_elapsed(t),
+                    over=_overdue(t, job.notBefore),
+                )
 
         returnValue(None)
 
@@ -391,8 +580,261 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
             if jobID:
                 job = yield cls.load(txn, jobID)
         else:
+            # Use any job already fetched in this transaction that still matches. The rows
+            # are locked by this transaction, so only changes made via other L{JobItem}
+            # instances in this transaction could have made them stale.
+            job = None
+            prefetched = cls._prefetched(txn)
+            while prefetched:
+                candidate = prefetched.popleft()
+                if (
+                    candidate.isAssigned == 0 and
+                    candidate.pause == 0 and
+                    candidate.notBefore <= now and
+                    candidate.priority >= minPriority
+                ):
+                    job = candidate
+                    break
+
+            if job is None:
+                limit = max(rowLimit, cls.prefetchBatch)
+                jobs = None
+                starved = yield cls._sampleStarved(txn, now)
+                if starved:
+                    jobs = yield cls.nextjobs(txn, now, minPriority, limit, lifo=True)
+                if not jobs:
+                    jobs = yield cls.nextjobs(txn, now, minPriority, limit)
+                if jobs:
+                    job = jobs[0]
+                    if len(jobs) > 1:
+                        cls._prefetched(txn, create=True).extend(jobs[1:])
+
+        returnValue(job)
+
+    @classmethod
+    @inlineCallbacks
+    def nextjobWithHint(cls, txn, now, minPriority, rowLimit, pollState):
+        """
+        Find the next available job, as per L{nextjob}, and also suggest how long to
+        wait before polling again based on how often recent polls found a job.
+
+        @param txn: the transaction to use
+        @type txn: L{IAsyncTransaction}
+        @param now: current timestamp
+        @type now: L{datetime.datetime}
+        @param minPriority: lowest priority level to query for
+        @type minPriority: L{int}
+        @param rowLimit: query at most this number of rows at a time
+        @type rowLimit: L{int}
+        @param pollState: the poll history of the caller, which is updated
+        @type pollState: L{PollState}
+
+        @return: the job record (or L{None}) and the suggested poll interval in seconds
+        @rtype: L{tuple} of (L{JobItem}, L{float})
+        """
+        job = yield cls.nextjob(txn, now, minPriority, rowLimit)
+        returnValue((job, pollState.update(job is not None),))
+
+    @classmethod
+    def _prefetched(cls, txn, create=False):
+        """
+        Get the queue of jobs fetched, but not yet returned, by L{nextjob} in this
+        transaction. The queue is only created once there are extra jobs to keep, and
+        is discarded when the transaction ends, since the row locks are released at
+        that point.
+
+        @param txn: the transaction to use
+        @type txn: L{IAsyncTransaction}
+        @param create: whether to create the queue if this transaction has none
+        @type create: L{bool}
+
+        @return: the queue of jobs, or an empty L{tuple} if there is none and
+            C{create} is C{False}
+        @rtype: L{deque} or L{tuple}
+        """
+        prefetched = getattr(txn, "_jobPrefetch", None)
+        if prefetched is None:
+            if not create:
+                return ()
+            prefetched = txn._jobPrefetch = deque()
+            txn.postCommit(prefetched.clear)
+            txn.postAbort(prefetched.clear)
+        return prefetched
+
+    @classmethod
+    @inlineCallbacks
+    def starved(cls, txn, now):
+        """
+        Determine whether the queue is backed up enough that newly queued jobs of
+        C{lifoEligible} work types should be run ahead of older jobs - i.e., whether
+        more than L{starvationThreshold} jobs are ready to run. Always L{False} if
+        L{starvationThreshold} is not set or no work types are C{lifoEligible}.
+
+        Note that this counts all the ready jobs, so its cost grows with the size of
+        the backlog - L{nextjob} only calls it every L{starvationCheckInterval} seconds.
+
+        @param txn: the transaction to use
+        @type txn: L{IAsyncTransaction}
+        @param now: current timestamp
+        @type now: L{datetime.datetime}
+
+        @return: a L{Deferred} that fires with L{True} if the queue is starved
+        @rtype: L{Deferred}
+        """
+        if cls.starvationThreshold is None or not cls._lifoWorkTypes:
+            returnValue(False)
+        ready = yield cls.count(
+            txn,
+            where=(cls.isAssigned == 0).And(cls.pause == 0).And(cls.notBefore <= now),
+        )
+        returnValue(ready > cls.starvationThreshold)
+
+    @classmethod
+    @inlineCallbacks
+    def _sampleStarved(cls, txn, now):
+        """
+        Determine whether the queue is starved, as per L{starved}, but re-use the
+        result of the previous check if it was made less than
+        L{starvationCheckInterval} seconds ago.
+
+        @param txn: the transaction to use
+        @type txn: L{IAsyncTransaction}
+        @param now: current timestamp
+        @type now: L{datetime.datetime}
+
+        @return: a L{Deferred} that fires with L{True} if the queue is starved
+        @rtype: L{Deferred}
+        """
+        if cls.starvationThreshold is None or not cls._lifoWorkTypes:
+            returnValue(False)
+        checked, starved = cls._starvationCheck
+        if checked is None or abs((now - checked).total_seconds()) >= cls.starvationCheckInterval:
+            starved = yield cls.starved(txn, now)
+            cls._starvationCheck = (now, starved,)
+        returnValue(starved)
+
+    @classmethod
+    def nextjobs(cls, txn, now, minPriority, limit, lifo=False):
+        """
+        Find and lock the next available jobs based on priority. This is not supported
+        for Oracle - see L{nextjob}.
+
+        When C{lifo} is L{True} only jobs of C{lifoEligible} work types are returned,
+        newest first within each priority level, so that recently queued work does not
+        wait behind a backlog - see L{_lifojobs}.
+
+        @param txn: the transaction to use
+        @type txn: L{IAsyncTransaction}
+        @param now: current timestamp
+        @type now: L{datetime.datetime}
+        @param minPriority: lowest priority level to query for
+        @type minPriority: L{int}
+        @param limit: query at most this number of rows
+        @type limit: L{int}
+        @param lifo: whether to only return the newest C{lifoEligible} jobs
+        @type lifo: L{bool}
+
+        @return: a L{Deferred} that fires with the L{JobItem}s, highest priority first
+        @rtype: L{Deferred}
+        """
+        skipLocked = "skip-locked" in txn.dbtype.options
+        if lifo:
+            return cls._lifojobs(txn, now, minPriority, limit, skipLocked)
+        return cls._rowsFromQuery(
+            txn,
+            cls._nextjobsQuery(minPriority, skipLocked),
+            None,
+            now=now,
+            limit=limit,
+        )
+
+    @classmethod
+    @inlineCallbacks
+    def _lifojobs(cls, txn, now, minPriority, limit, skipLocked):
+        """
+        Find and lock the newest available jobs of C{lifoEligible} work types. The DAL
+        can only apply one sort direction to all the ORDER BY columns, so each priority
+        level is queried in turn, highest first, ordered by NOT_BEFORE descending.
+
+        @param txn: the transaction to use
+        @type txn: L{IAsyncTransaction}
+        @param now: current timestamp
+        @type now: L{datetime.datetime}
+        @param minPriority: lowest priority level to query for
+        @type minPriority: L{int}
+        @param limit: return at most this number of jobs
+        @type limit: L{int}
+        @param skipLocked: whether to use SKIP LOCKED with the FOR UPDATE
+        @type skipLocked: L{bool}
+
+        @return: a L{Deferred} that fires with the L{JobItem}s, highest priority first
+        @rtype: L{Deferred}
+        """
+        lifoWorkTypes = tuple(cls._lifoWorkTypes)
+        jobs = []
+        for priority in range(JOB_PRIORITY_HIGH, minPriority - 1, -1):
+            jobs.extend((yield cls._rowsFromQuery(
+                txn,
+                cls._lifojobsQuery(priority, skipLocked, lifoWorkTypes),
+                None,
+                now=now,
+                limit=limit - len(jobs),
+            )))
+            if len(jobs) >= limit:
+                break
+        returnValue(jobs)
+
+    @classmethod
+    def _lifojobsQuery(cls, priority, skipLocked, lifoWorkTypes):
+        """
+        Get the query used by L{_lifojobs} for one priority level, cached like the
+        L{nextjobs} queries.
+
+        @param priority: the priority level to query for
+        @type priority: L{int}
+        @param skipLocked: whether to use SKIP LOCKED with the FOR UPDATE
+        @type skipLocked: L{bool}
+        @param lifoWorkTypes: the work types to query for
+        @type lifoWorkTypes: L{tuple} of L{str}
+
+        @return: the query
+        @rtype: L{Select}
+        """
+        key = ("lifo", priority, skipLocked, lifoWorkTypes,)
+        if key not in cls._nextjobsQueries:
+            queryExpr = (cls.isAssigned == 0).And(cls.pause == 0).And(cls.notBefore <= Parameter("now"))
+            queryExpr = (cls.priority == priority).And(cls.workType.In(lifoWorkTypes)).And(queryExpr)
+            cls._nextjobsQueries[key] = cls.queryExpr(
+                queryExpr,
+                order=cls.notBefore,
+                ascending=False,
+                forUpdate=True,
+                noWait=False,
+                skipLocked=skipLocked,
+                limit=Parameter("limit"),
+            )
+
+        return cls._nextjobsQueries[key]
+
+    @classmethod
+    def _nextjobsQuery(cls, minPriority, skipLocked):
+        """
+        Get the query used by L{nextjobs}. There are only a few variations of it, so
+        each is built once and cached, with the current time and the row limit bound
+        as parameters when it is executed.
+
+        @param minPriority: lowest priority level to query for
+        @type minPriority: L{int}
+        @param skipLocked: whether to use SKIP LOCKED with the FOR UPDATE
+        @type skipLocked: L{bool}
+
+        @return: the query
+        @rtype: L{Select}
+        """
+        key = (minPriority, skipLocked,)
+        if key not in cls._nextjobsQueries:
             # Only add the PRIORITY term if minimum is greater than zero
-            queryExpr = (cls.isAssigned == 0).And(cls.pause == 0).And(cls.notBefore <= now)
+            queryExpr = (cls.isAssigned == 0).And(cls.pause == 0).And(cls.notBefore <= Parameter("now"))
 
             # PRIORITY can only be 0, 1, or 2. So we can convert an inequality into
             # an equality test as follows:
@@ -409,22 +851,17 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
             elif minPriority == JOB_PRIORITY_HIGH:
                 queryExpr = (cls.priority == JOB_PRIORITY_HIGH).And(queryExpr)
 
-            extra_kwargs = {}
-            if "skip-locked" in txn.dbtype.options:
-                extra_kwargs["skipLocked"] = True
-            jobs = yield cls.query(
-                txn,
+            cls._nextjobsQueries[key] = cls.queryExpr(
                 queryExpr,
                 order=cls.priority,
                 ascending=False,
                 forUpdate=True,
                 noWait=False,
-                limit=rowLimit,
-                **extra_kwargs
+                skipLocked=skipLocked,
+                limit=Parameter("limit"),
             )
-            job = jobs[0] if jobs else None
 
-        returnValue(job)
+        return cls._nextjobsQueries[key]
 
     @classmethod
     @inlineCallbacks
@@ -476,14 +913,13 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
         running that, with appropriate locking.
         """
 
-        workItem = yield self.workItem()
-        if workItem is not None:
-
-            # First we lock the L{WorkItem}
-            locked = yield workItem.runlock()
-            if not locked:
-                raise JobRunningError()
+        # First we load and lock the L{WorkItem}
+        workItemClass = workItemForType(self.workType)
+        workItem, locked = yield workItemClass.loadAndLockForJob(self.transaction, self.jobID)
+        if not locked:
+            raise JobRunningError()
 
+        if workItem is not None:
             try:
                 # Run in three steps, allowing for before/after hooks that sub-classes
                 # may override
@@ -517,19 +953,16 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
         """
         Return L{True} if the job is currently running (its L{WorkItem} is locked).
         """
-        workItem = yield self.workItem()
-        if workItem is not None:
-            locked = yield workItem.trylock()
-            returnValue(not locked)
-        else:
-            returnValue(False)
+        workItemClass = workItemForType(self.workType)
+        locked = yield workItemClass.trylockForJob(self.transaction, self.jobID)
+        returnValue(not locked)
 
     @inlineCallbacks
     def workItem(self):
         """
         Return the L{WorkItem} corresponding to this L{JobItem}.
         """
-        workItemClass = self.workItemForType(self.workType)
+        workItemClass = workItemForType(self.workType)
         workItems = yield workItemClass.loadForJob(
             self.transaction, self.jobID
         )
@@ -543,9 +976,28 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
         @param workType: the name of the L{WorkItem}'s table
         @type workType: L{str}
         """
-        if cls._workTypeMap is None:
-            cls.workTypes()
-        return cls._workTypeMap[workType]
+        return workItemForType(workType)
+
+    @classmethod
+    def registerWorkType(cls, workItemClass):
+        """
+        Register a L{WorkItem} sub-class so that jobs of its type can be run. This is
+        called automatically when a L{WorkItem} sub-class mapped to a table is defined.
+
+        @param workItemClass: the L{WorkItem} sub-class
+        @type workItemClass: L{type}
+        """
+        workType = workItemClass.workType()
+        previous = _workTypeMap.get(workType)
+        if previous is not None:
+            _workTypes.remove(previous)
+        _workTypes.append(workItemClass)
+        _workTypeMap[workType] = workItemClass
+
+        if workType in cls._lifoWorkTypes:
+            cls._lifoWorkTypes.remove(workType)
+        if workItemClass.lifoEligible:
+            cls._lifoWorkTypes.append(workType)
 
     @classmethod
     def workTypes(cls):
@@ -555,23 +1007,7 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
         @return: All of the work item types.
         @rtype: iterable of L{WorkItem} subclasses
         """
-        if cls._workTypes is None:
-            cls._workTypes = []
-
-            def getWorkType(subcls, appendTo):
-                if hasattr(subcls, "table"):
-                    appendTo.append(subcls)
-                else:
-                    for subsubcls in subcls.__subclasses__():
-                        getWorkType(subsubcls, appendTo)
-            from twext.enterprise.jobs.workitem import WorkItem
-            getWorkType(WorkItem, cls._workTypes)
-
-            cls._workTypeMap = {}
-            for subcls in cls._workTypes:
-                cls._workTypeMap[subcls.workType()] = subcls
-
-        return cls._workTypes
+        return _workTypes
 
     @classmethod
     def allWorkTypes(cls):
@@ -581,81 +1017,55 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
         @return: All of the work item types.
         @rtype: L{dict}
         """
-        if cls._workTypeMap is None:
-            cls.workTypes()
-        return cls._workTypeMap
+        return _workTypeMap
 
     @classmethod
     def numberOfWorkTypes(cls):
         return len(cls.workTypes())
 
     @classmethod
-    @inlineCallbacks
     def waitEmpty(cls, txnCreator, reactor, timeout):
         """
         Wait for the job queue to drain. Only use this in tests
         that need to wait for results from jobs.
         """
-        t = time.time()
-        while True:
-            work = yield inTransaction(txnCreator, cls.all)
-            if not work:
-                break
-            if time.time() - t > timeout:
-                returnValue(False)
-            d = Deferred()
-            reactor.callLater(0.1, lambda: d.callback(None))
-            yield d
+        @inlineCallbacks
+        def _empty(txn):
+            work = yield cls.exists(txn)
+            returnValue(not work)
 
-        returnValue(True)
+        return _pollUntil(txnCreator, reactor, timeout, _empty)
 
     @classmethod
-    @inlineCallbacks
     def waitJobDone(cls, txnCreator, reactor, timeout, jobID):
         """
         Wait for the specified job to complete. Only use this in tests
         that need to wait for results from jobs.
         """
-        t = time.time()
-        while True:
-            work = yield inTransaction(txnCreator, cls.query, expr=(cls.jobID == jobID))
-            if not work:
-                break
-            if time.time() - t > timeout:
-                returnValue(False)
-            d = Deferred()
-            reactor.callLater(0.1, lambda: d.callback(None))
-            yield d
+        @inlineCallbacks
+        def _done(txn):
+            work = yield cls.exists(txn, (cls.jobID == jobID))
+            returnValue(not work)
 
-        returnValue(True)
+        return _pollUntil(txnCreator, reactor, timeout, _done)
 
     @classmethod
-    @inlineCallbacks
     def waitWorkDone(cls, txnCreator, reactor, timeout, workTypes):
         """
         Wait for the specified job to complete. Only use this in tests
         that need to wait for results from jobs.
         """
-        t = time.time()
-        while True:
-            count = [0]
-
-            @inlineCallbacks
-            def _countTypes(txn):
-                for t in workTypes:
-                    work = yield t.all(txn)
-                    count[0] += len(work)
-
-            yield inTransaction(txnCreator, _countTypes)
-            if count[0] == 0:
-                break
-            if time.time() - t > timeout:
-                returnValue(False)
-            d = Deferred()
-            reactor.callLater(0.1, lambda: d.callback(None))
-            yield d
+        @inlineCallbacks
+        def _noWork(txn):
+            # The checks are independent, so issue them all at once rather than
+            # waiting for each in turn
+            work = yield gatherResults(
+                [workType.exists(txn) for workType in workTypes],
+                consumeErrors=True,
+            )
+            returnValue(not any(work))
 
-        returnValue(True)
+        return _pollUntil(txnCreator, reactor, timeout, _noWork)
 
     @classmethod
     @inlineCallbacks
@@ -706,16 +1116,120 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
         returnValue(results)
 
 
-JobDescriptor = namedtuple("JobDescriptor", ["jobID", "weight", "workType"])
+class JobDescriptor(object):
+    """
+    The details of a L{JobItem} needed to dispatch it to a worker: its job ID,
+    weight and work type. Slotted, since one is created for every job that is
+    assigned, but otherwise behaves like the C{namedtuple} it replaces: it can
+    be indexed, unpacked, C{_replace}d and pickled, and compares and hashes
+    like the equivalent tuple.
+    """
+
+    __slots__ = ("jobID", "weight", "workType",)
+    _fields = __slots__
+
+    def __init__(self, jobID, weight, workType):
+        self.jobID = jobID
+        self.weight = weight
+        self.workType = workType
+
+    def __iter__(self):
+        yield self.jobID
+        yield self.weight
+        yield self.workType
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+    def _replace(self, **kwargs):
+        values = dict(zip(self._fields, self))
+        values.update(kwargs)
+        return JobDescriptor(**values)
+
+    def __reduce__(self):
+        # Slotted classes can't otherwise be pickled below protocol 2
+        return (JobDescriptor, tuple(self),)
+
+    def __eq__(self, other):
+        if not isinstance(other, (JobDescriptor, tuple,)):
+            return NotImplemented
+        return tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return "JobDescriptor(jobID={!r}, weight={!r}, workType={!r})".format(*self)
 
 
 class JobDescriptorArg(Argument):
     """
-    Comma-separated representation of an L{JobDescriptor} for AMP-serialization.
+    Fixed-layout binary representation of an L{JobDescriptor} for
+    AMP-serialization: the job ID and weight packed as network-order integers,
+    followed by the utf-8 encoded work type.
     """
 
+    _header = struct.Struct("!qi")
+
     def toString(self, inObject):
-        return ",".join(map(str, inObject))
+        return self._header.pack(inObject.jobID, inObject.weight) + inObject.workType.encode("utf-8")
 
     def fromString(self, inString):
-        return JobDescriptor(*[f(s) for f, s in zip((int, int, str,), inString.split(","))])
+        jobID, weight = self._header.unpack_from(inString)
+        return JobDescriptor(jobID, weight, inString[self._header.size:].decode("utf-8"))
+
+
+class PollState(object):
+    """
+    Tracks the outcome of successive job queue polls to suggest the interval
+    before the next one - see L{JobItem.nextjobWithHint}. The interval grows by
+    L{missFactor} each time a poll finds nothing and shrinks by L{hitFactor} each
+    time one finds a job, always staying between C{minInterval} and C{maxInterval}.
+    That way an idle queue is polled rarely, while a busy one is polled at close to
+    the minimum interval.
+
+    @ivar interval: the current suggested poll interval in seconds
+    @type interval: L{float}
+    @ivar hits: the number of polls that found a job
+    @type hits: L{int}
+    @ivar misses: the number of polls that found nothing
+    @type misses: L{int}
+    """
+
+    __slots__ = ("minInterval", "maxInterval", "interval", "hits", "misses",)
+
+    missFactor = 1.5
+    hitFactor = 0.5
+
+    def __init__(self, minInterval=0.1, maxInterval=60.0):
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.interval = minInterval
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, found):
+        """
+        Record the outcome of a poll.
+
+        @param found: whether the poll found a job
+        @type found: L{bool}
+
+        @return: the suggested interval before the next poll in seconds
+        @rtype: L{float}
+        """
+        if found:
+            self.hits += 1
+            interval = self.interval * self.hitFactor
+        else:
+            self.misses += 1
+            interval = self.interval * self.missFactor
+        self.interval = min(self.maxInterval, max(self.minInterval, interval))
+        return self.interval
@@ -27,6 +27,7 @@ from twisted.application.service import MultiService
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred, succeed
 from twisted.internet.error import AlreadyCalled, AlreadyCancelled
 from twisted.internet.protocol import Factory
+from twisted.logger import LogLevel
 from twisted.protocols.amp import AMP, Command
 
 from zope.interface import implements
@@ -84,6 +85,11 @@ class PerformJob(Command):
     the database, by informing it of the job ID.
     """
 
+    # The wire name changes along with the L{JobDescriptorArg} encoding so
+    # that a peer running older code rejects the command rather than
+    # misinterpreting its argument.
+    commandName = "PerformJobDescriptor"
+
     arguments = [
         ("job", JobDescriptorArg()),
     ]
@@ -553,7 +559,8 @@ class ControllerQueue(_BaseQueuer, MultiService, object):
                     break
 
                 # Always assign as a new job even when it is an orphan
-                log.debug("workCheck: assigned job: {jobID}".format(jobID=nextJob.jobID))
+                if log.isEnabledFor(LogLevel.debug):
+                    log.debug("workCheck: assigned job: {jobID}", jobID=nextJob.jobID)
                 yield nextJob.assign(nowTime, self.queueOverdueTimeout)
                 self._timeOfLastWork = time.time()
                 loopCounter += 1
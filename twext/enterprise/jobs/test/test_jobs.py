@@ -19,6 +19,7 @@ Tests for L{twext.enterprise.job.queue}.
 """
 
 import datetime
+import pickle
 
 from zope.interface.verify import verifyObject
 
@@ -28,23 +29,25 @@ from twisted.test.proto_helpers import StringTransport, MemoryReactor
 from twisted.internet.defer import \
     Deferred, inlineCallbacks, gatherResults, passthru, returnValue, succeed, \
     CancelledError
-from twisted.internet.task import Clock as _Clock
+from twisted.internet.task import Clock as _Clock, deferLater
 from twisted.protocols.amp import Command, AMP, Integer
 from twisted.application.service import Service, MultiService
 
-from twext.enterprise.dal.syntax import SchemaSyntax, Delete
+from twext.enterprise.dal.syntax import SchemaSyntax, Delete, Select
 from twext.enterprise.dal.parseschema import splitSQLString
-from twext.enterprise.dal.record import fromTable
+from twext.enterprise.dal.record import fromTable, NoSuchRecord
 from twext.enterprise.dal.test.test_parseschema import SchemaTestHelper
 from twext.enterprise.fixtures import buildConnectionPool
 from twext.enterprise.fixtures import SteppablePoolHelper
 from twext.enterprise.jobs.utils import inTransaction, astimestamp
+from twext.enterprise.jobs import workitem
 from twext.enterprise.jobs.workitem import \
     WorkItem, SingletonWorkItem, \
     WORK_PRIORITY_LOW, WORK_PRIORITY_HIGH, WORK_PRIORITY_MEDIUM, WORK_WEIGHT_5, \
     WORK_WEIGHT_1, WORK_WEIGHT_10, WORK_WEIGHT_0
 from twext.enterprise.jobs.jobitem import \
-    JobItem, JobDescriptor, JobFailedError, JobTemporaryError
+    JobItem, JobDescriptor, JobDescriptorArg, JobFailedError, JobTemporaryError, \
+    PollState
 from twext.enterprise.jobs.queue import \
     WorkerConnectionPool, ControllerQueue, \
     LocalPerformer, _IJobPerformer, \
@@ -389,6 +392,46 @@ class AMPTests(TestCase):
         self.assertEqual(server.it, 123)
 
 
+    def test_jobDescriptor(self):
+        """
+        L{JobDescriptor} behaves like a tuple of its job ID, weight and work type.
+        """
+        descriptor = JobDescriptor(1, 5, "DUMMY_WORK_ITEM")
+        self.assertEqual(descriptor, (1, 5, "DUMMY_WORK_ITEM"))
+        self.assertEqual((1, 5, "DUMMY_WORK_ITEM"), descriptor)
+        self.assertNotEqual(descriptor, (1, 6, "DUMMY_WORK_ITEM"))
+        self.assertNotEqual(descriptor, [1, 5, "DUMMY_WORK_ITEM"])
+        self.assertEqual(hash(descriptor), hash((1, 5, "DUMMY_WORK_ITEM")))
+        self.assertEqual(len(descriptor), 3)
+        self.assertEqual(descriptor[0], 1)
+        self.assertEqual(descriptor[-1], "DUMMY_WORK_ITEM")
+        jobID, weight, workType = descriptor
+        self.assertEqual((jobID, weight, workType), (1, 5, "DUMMY_WORK_ITEM"))
+        self.assertEqual(descriptor._replace(weight=7), (1, 7, "DUMMY_WORK_ITEM"))
+        self.assertEqual(descriptor.weight, 5)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEqual(pickle.loads(pickle.dumps(descriptor, protocol)), descriptor)
+
+
+    def test_jobDescriptorArg(self):
+        """
+        L{JobDescriptorArg} round-trips a L{JobDescriptor} as bytes, including
+        large job IDs and weights, unicode work types (as loaded from the
+        database) and work types containing commas.
+        """
+        arg = JobDescriptorArg()
+        for descriptor in (
+            JobDescriptor(1, 5, "DUMMY_WORK_ITEM"),
+            JobDescriptor(200, 128, u"DUMMY_WORK_ITEM"),
+            JobDescriptor(2 ** 40, 0, "ODD,NAME"),
+        ):
+            encoded = arg.toString(descriptor)
+            self.assertTrue(isinstance(encoded, bytes))
+            decoded = arg.fromString(encoded)
+            self.assertEqual(decoded, descriptor)
+            self.assertTrue(isinstance(decoded.workType, unicode))
+
+
 class WorkItemTests(TestCase):
     """
     A L{WorkItem} is an item of work that can be executed.
@@ -489,6 +532,412 @@ class WorkItemTests(TestCase):
         self.assertTrue(jobs[0].assigned is not None)
         self.assertEqual(jobs[0].isAssigned, 1)
 
+    @inlineCallbacks
+    def test_loadAndLockForJob(self):
+        """
+        L{WorkItem.loadAndLockForJob} loads and locks the L{WorkItem} for a job,
+        or returns L{None} for a job without one.
+        """
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        yield self._enqueue(dbpool, 1, 2, cl=UpdateWorkItem)
+
+        def checkJob(txn):
+            return JobItem.all(txn)
+
+        jobs = yield inTransaction(dbpool.connection, checkJob)
+        jobID = jobs[0].jobID
+
+        workItem, locked = yield inTransaction(dbpool.connection, UpdateWorkItem.loadAndLockForJob, jobID=jobID)
+        self.assertTrue(locked)
+        self.assertEqual((workItem.jobID, workItem.a, workItem.b), (jobID, 1, 2))
+
+        workItem, locked = yield inTransaction(dbpool.connection, UpdateWorkItem.loadAndLockForJob, jobID=jobID + 1)
+        self.assertTrue(locked)
+        self.assertTrue(workItem is None)
+
+    @inlineCallbacks
+    def test_loadAndLockForJobErrors(self):
+        """
+        L{WorkItem.loadAndLockForJob} reports the L{WorkItem} as locked when only
+        the locking query fails, and raises when the L{WorkItem} can't be loaded
+        at all.
+        """
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        yield self._enqueue(dbpool, 1, 2, cl=UpdateWorkItem)
+
+        def checkJob(txn):
+            return JobItem.all(txn)
+
+        jobs = yield inTransaction(dbpool.connection, checkJob)
+        jobID = jobs[0].jobID
+
+        failures = [1]
+        oldRowsFromQuery = UpdateWorkItem._rowsFromQuery.__func__
+
+        def _rowsFromQuery(cls, *args, **kwargs):
+            if failures[0]:
+                failures[0] -= 1
+                raise RuntimeError("Query failed")
+            return oldRowsFromQuery(cls, *args, **kwargs)
+        self.patch(UpdateWorkItem, "_rowsFromQuery", classmethod(_rowsFromQuery))
+
+        workItem, locked = yield inTransaction(dbpool.connection, UpdateWorkItem.loadAndLockForJob, jobID=jobID)
+        self.assertFalse(locked)
+        self.assertEqual(workItem.jobID, jobID)
+
+        failures[0] = 2
+        yield self.assertFailure(
+            inTransaction(dbpool.connection, UpdateWorkItem.loadAndLockForJob, jobID=jobID),
+            RuntimeError,
+        )
+
+        failures[0] = 1
+        yield self.assertFailure(
+            inTransaction(dbpool.connection, UpdateWorkItem.loadAndLockForJob, jobID=jobID + 1),
+            RuntimeError,
+        )
+
+    @inlineCallbacks
+    def test_isRunning(self):
+        """
+        L{JobItem.isRunning} is L{True} only when the job's L{WorkItem} can't be
+        locked, using L{WorkItem.trylockForJob} directly unless the L{WorkItem}
+        sub-class overrides L{WorkItem.loadForJob}.
+        """
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        yield self._enqueue(dbpool, 1, 2, cl=UpdateWorkItem)
+        yield self._enqueue(dbpool, 3, 4, cl=DummyWorkItem)
+
+        @inlineCallbacks
+        def _running(txn):
+            jobs = yield JobItem.all(txn)
+            running = {}
+            for job in jobs:
+                running[job.workType] = yield job.isRunning()
+            returnValue(running)
+
+        running = yield inTransaction(dbpool.connection, _running)
+        self.assertEqual(running, {"UPDATE_WORK_ITEM": False, "DUMMY_WORK_ITEM": False})
+
+        # A failed select for update no wait means the work is locked
+        def _select(*args, **kwargs):
+            if kwargs.get("NoWait"):
+                raise RuntimeError("Row is locked")
+            return Select(*args, **kwargs)
+        self.patch(workitem, "Select", _select)
+
+        running = yield inTransaction(dbpool.connection, _running)
+        self.assertEqual(running, {"UPDATE_WORK_ITEM": True, "DUMMY_WORK_ITEM": False})
+
+        # L{DummyWorkItem} overrides L{WorkItem.loadForJob}, so is locked with trylock
+        trylocked = []
+
+        def _trylock(self, where=None):
+            trylocked.append(self.jobID)
+            return succeed(False)
+        self.patch(DummyWorkItem, "trylock", _trylock)
+
+        running = yield inTransaction(dbpool.connection, _running)
+        self.assertEqual(running, {"UPDATE_WORK_ITEM": True, "DUMMY_WORK_ITEM": True})
+        self.assertEqual(len(trylocked), 1)
+
+    @inlineCallbacks
+    def test_bumpFailure(self):
+        """
+        L{JobItem.bumpFailure} unassigns a job and increments its failure count,
+        unless the failure was due to a lock, without the job being loaded.
+        """
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        yield self._enqueue(dbpool, 1, 2)
+
+        def checkJob(txn):
+            return JobItem.all(txn)
+
+        jobs = yield inTransaction(dbpool.connection, checkJob)
+        jobID = jobs[0].jobID
+
+        @inlineCallbacks
+        def assignJob(txn):
+            job = yield JobItem.load(txn, jobID)
+            yield job.assign(datetime.datetime.utcnow(), ControllerQueue.queueOverdueTimeout)
+        yield inTransaction(dbpool.connection, assignJob)
+
+        yield inTransaction(dbpool.connection, JobItem.bumpFailure, jobID=jobID, delay=60)
+        yield inTransaction(dbpool.connection, JobItem.bumpFailure, jobID=jobID, delay=60)
+        yield inTransaction(dbpool.connection, JobItem.bumpFailure, jobID=jobID, delay=60, locked=True)
+
+        jobs = yield inTransaction(dbpool.connection, checkJob)
+        self.assertEqual(jobs[0].failed, 2)
+        self.assertEqual(jobs[0].isAssigned, 0)
+        self.assertTrue(jobs[0].assigned is None)
+        self.assertTrue(jobs[0].notBefore > datetime.datetime.utcnow())
+
+        yield self.assertFailure(
+            inTransaction(dbpool.connection, JobItem.bumpFailure, jobID=jobID + 1, delay=60),
+            NoSuchRecord,
+        )
+
+    @inlineCallbacks
+    def test_failedToRun(self):
+        """
+        L{JobItem.failedToRun} keeps the in-memory record in sync with the updated
+        row, and does nothing if the job has been deleted.
+        """
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        yield self._enqueue(dbpool, 1, 2)
+
+        @inlineCallbacks
+        def failJob(txn):
+            jobs = yield JobItem.all(txn)
+            job = jobs[0]
+            yield job.assign(datetime.datetime.utcnow(), ControllerQueue.queueOverdueTimeout)
+            yield job.failedToRun(delay=60)
+            yield job.failedToRun(locked=True, delay=60)
+            reloaded = yield JobItem.load(txn, job.jobID)
+            returnValue((job, reloaded,))
+        job, reloaded = yield inTransaction(dbpool.connection, failJob)
+        for attr in ("isAssigned", "assigned", "overdue", "failed", "notBefore",):
+            self.assertEqual(getattr(job, attr), getattr(reloaded, attr), attr)
+        self.assertEqual(job.failed, 1)
+        self.assertEqual(job.isAssigned, 0)
+
+        @inlineCallbacks
+        def failDeletedJob(txn):
+            job = yield JobItem.load(txn, reloaded.jobID)
+            yield job.delete()
+            yield job.failedToRun(delay=60)
+            jobs = yield JobItem.all(txn)
+            returnValue(jobs)
+        jobs = yield inTransaction(dbpool.connection, failDeletedJob)
+        self.assertEqual(jobs, [])
+
+    @inlineCallbacks
+    def _ultimatelyPerformFailure(self, a, failed):
+        """
+        Run a L{DummyWorkItem} job that fails, with the given prior failure count.
+
+        @return: a L{Deferred} firing with the time before the job was run and
+            the reloaded job
+        """
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        yield self._enqueue(dbpool, a, 0)
+
+        @inlineCallbacks
+        def _setFailed(txn):
+            jobs = yield JobItem.all(txn)
+            yield jobs[0].update(failed=failed)
+            returnValue(jobs[0].descriptor())
+        descriptor = yield inTransaction(dbpool.connection, _setFailed)
+
+        before = datetime.datetime.utcnow()
+        yield JobItem.ultimatelyPerform(dbpool.connection, descriptor)
+        job = yield inTransaction(dbpool.connection, lambda txn: JobItem.load(txn, descriptor.jobID))
+        returnValue((before, job,))
+
+    @inlineCallbacks
+    def test_ultimatelyPerformTemporaryFailure(self):
+        """
+        When a L{WorkItem} raises L{JobTemporaryError}, L{JobItem.ultimatelyPerform}
+        reschedules the job no sooner than the requested delay, and bumps its failure
+        count.
+        """
+        before, job = yield self._ultimatelyPerformFailure(-2, 0)
+        self.assertEqual(job.failed, 1)
+        self.assertEqual(job.isAssigned, 0)
+        self.assertTrue(job.notBefore >= before + datetime.timedelta(seconds=120))
+
+    @inlineCallbacks
+    def test_ultimatelyPerformFailure(self):
+        """
+        When a L{WorkItem} fails, L{JobItem.ultimatelyPerform} reschedules the job
+        with the back-off for its failure count, and bumps its failure count.
+        """
+        before, job = yield self._ultimatelyPerformFailure(-1, 3)
+        after = datetime.datetime.utcnow()
+        self.assertEqual(job.failed, 4)
+        self.assertEqual(job.isAssigned, 0)
+
+        # 3 prior failures multiply the interval by 8, with up to half removed as jitter
+        expected = JobItem.failureRescheduleInterval * 8
+        self.assertTrue(job.notBefore >= before + datetime.timedelta(seconds=expected / 2.0))
+        self.assertTrue(job.notBefore <= after + datetime.timedelta(seconds=expected))
+
+    def test_backoffDelay(self):
+        """
+        L{JobItem.backoffDelay} grows exponentially with the failure count up to
+        L{JobItem.maxRescheduleInterval}, with up to half of the delay removed as
+        jitter.
+        """
+        for failed, expected in (
+            (0, 60),
+            (1, 120),
+            (3, 480),
+            (10, JobItem.maxRescheduleInterval),
+        ):
+            job = JobItem.make(
+                workType="DUMMY_WORK_ITEM",
+                notBefore=datetime.datetime.utcnow(),
+                failed=failed,
+            )
+            delay = job.backoffDelay(60)
+            self.assertTrue(expected / 2.0 <= delay <= expected)
+
+        # A float interval (e.g. from L{JobTemporaryError}) with a huge failure count
+        # must not overflow
+        job = JobItem.make(
+            workType="DUMMY_WORK_ITEM",
+            notBefore=datetime.datetime.utcnow(),
+            failed=1100,
+        )
+        delay = job.backoffDelay(0.5)
+        self.assertTrue(JobItem.maxRescheduleInterval / 2.0 <= delay <= JobItem.maxRescheduleInterval)
+
+    @inlineCallbacks
+    def _pollWithClock(self, clock, d, onDelay=None):
+        """
+        Drive one of the L{JobItem} wait helpers, which use C{clock} for their
+        delays, to completion.
+
+        @param onDelay: called with the number of delays so far, and waited on,
+            before each delay is skipped
+        @return: a L{Deferred} firing with the result of C{d} and the list of
+            delays, in seconds, that were waited for
+        """
+        delays = []
+        while not d.called:
+            calls = clock.getDelayedCalls()
+            if calls:
+                if onDelay is not None:
+                    yield onDelay(len(delays))
+                delay = calls[0].getTime() - clock.seconds()
+                delays.append(round(delay, 6))
+                clock.advance(delay)
+            else:
+                # Let the database thread finish the current poll
+                yield deferLater(reactor, 0.01, lambda: None)
+        result = yield d
+        returnValue((result, delays,))
+
+    @inlineCallbacks
+    def test_waitEmpty(self):
+        """
+        L{JobItem.waitEmpty} polls with a doubling interval, up to a maximum, and
+        fires with L{False} when the timeout expires with jobs still queued, or
+        with L{True} as soon as the queue is empty.
+        """
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        clock = Clock()
+
+        result, delays = yield self._pollWithClock(
+            clock, JobItem.waitEmpty(dbpool.connection, clock, 5)
+        )
+        self.assertTrue(result is True)
+        self.assertEqual(delays, [])
+
+        yield self._enqueue(dbpool, 1, 2)
+        result, delays = yield self._pollWithClock(
+            clock, JobItem.waitEmpty(dbpool.connection, clock, 5)
+        )
+        self.assertTrue(result is False)
+        self.assertEqual(delays, [0.1, 0.2, 0.4, 0.8, 1.6, 2.0])
+
+        def _emptyQueue(count):
+            if count == 2:
+                return inTransaction(dbpool.connection, JobItem.deleteall)
+        result, delays = yield self._pollWithClock(
+            clock, JobItem.waitEmpty(dbpool.connection, clock, 5), _emptyQueue
+        )
+        self.assertTrue(result is True)
+        self.assertEqual(delays, [0.1, 0.2, 0.4])
+
+    @inlineCallbacks
+    def test_waitJobDone(self):
+        """
+        L{JobItem.waitJobDone} waits for just the given job to be removed.
+        """
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        clock = Clock()
+        yield self._enqueue(dbpool, 1, 2)
+        yield self._enqueue(dbpool, 3, 4)
+        jobs = yield inTransaction(dbpool.connection, JobItem.all)
+        jobID = jobs[0].jobID
+
+        result, delays = yield self._pollWithClock(
+            clock, JobItem.waitJobDone(dbpool.connection, clock, 1, jobID)
+        )
+        self.assertTrue(result is False)
+        self.assertEqual(delays, [0.1, 0.2, 0.4, 0.8])
+
+        def _removeJob(count):
+            if count == 1:
+                return inTransaction(
+                    dbpool.connection, JobItem.deletesome, where=(JobItem.jobID == jobID)
+                )
+        result, delays = yield self._pollWithClock(
+            clock, JobItem.waitJobDone(dbpool.connection, clock, 5, jobID), _removeJob
+        )
+        self.assertTrue(result is True)
+        self.assertEqual(delays, [0.1, 0.2])
+        jobs = yield inTransaction(dbpool.connection, JobItem.all)
+        self.assertEqual(len(jobs), 1)
+
+    @inlineCallbacks
+    def test_waitWorkDone(self):
+        """
+        L{JobItem.waitWorkDone} waits for the given work item tables to be empty.
+        """
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        clock = Clock()
+        yield self._enqueue(dbpool, 1, 2)
+
+        def _removeWork(count):
+            if count == 1:
+                return inTransaction(dbpool.connection, DummyWorkItem.deleteall)
+        result, delays = yield self._pollWithClock(
+            clock, JobItem.waitWorkDone(dbpool.connection, clock, 5, [DummyWorkItem]), _removeWork
+        )
+        self.assertTrue(result is True)
+        self.assertEqual(delays, [0.1, 0.2])
+
+    @inlineCallbacks
+    def test_waitWorkDoneMultiple(self):
+        """
+        L{JobItem.waitWorkDone} checks every given work type, and keeps waiting
+        while any one of them has work.
+        """
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        clock = Clock()
+        yield self._enqueue(dbpool, 1, 2)
+
+        result, delays = yield self._pollWithClock(
+            clock, JobItem.waitWorkDone(dbpool.connection, clock, 1, [DummyWorkPauseItem, UpdateWorkItem])
+        )
+        self.assertTrue(result is True)
+        self.assertEqual(delays, [])
+
+        for workTypes in (
+            [DummyWorkPauseItem, DummyWorkItem],
+            [DummyWorkItem, DummyWorkPauseItem],
+        ):
+            result, delays = yield self._pollWithClock(
+                clock, JobItem.waitWorkDone(dbpool.connection, clock, 1, workTypes)
+            )
+            self.assertTrue(result is False)
+            self.assertEqual(delays, [0.1, 0.2, 0.4, 0.8])
+
+    def test_pollState(self):
+        """
+        L{PollState} lengthens the suggested poll interval, up to its maximum, while
+        polls find nothing, and shortens it, down to its minimum, when they find jobs.
+        """
+        state = PollState(minInterval=1.0, maxInterval=3.0)
+        self.assertEqual(state.update(False), 1.5)
+        self.assertEqual(state.update(False), 2.25)
+        self.assertEqual(state.update(False), 3.0)
+        self.assertEqual(state.update(True), 1.5)
+        self.assertEqual(state.update(True), 1.0)
+        self.assertEqual((state.hits, state.misses), (2, 3))
+
     @inlineCallbacks
     def test_nextjob(self):
         """
@@ -579,6 +1028,154 @@ class WorkItemTests(TestCase):
         self.assertTrue(job is None)
         self.assertTrue(work is None)
 
+    @inlineCallbacks
+    def test_nextjobWithHint(self):
+        """
+        L{JobItem.nextjobWithHint} returns the same job as L{JobItem.nextjob}, moving
+        on to the next available job once the previous one has been assigned, with a
+        poll interval that shrinks while jobs are found and grows when none are.
+        """
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        now = datetime.datetime.utcnow()
+        yield self._enqueue(dbpool, 1, 1, now + datetime.timedelta(days=-1), priority=WORK_PRIORITY_HIGH)
+        yield self._enqueue(dbpool, 2, 1, now + datetime.timedelta(days=-1))
+        pollState = PollState(minInterval=1.0, maxInterval=8.0)
+        pollState.interval = 4.0
+
+        @inlineCallbacks
+        def _next(txn):
+            expected = yield JobItem.nextjob(txn, now, WORK_PRIORITY_LOW, 1)
+            job, interval = yield JobItem.nextjobWithHint(txn, now, WORK_PRIORITY_LOW, 1, pollState)
+            if job is not None:
+                self.assertEqual(job.jobID, expected.jobID)
+                yield job.assign(now, ControllerQueue.queueOverdueTimeout)
+            else:
+                self.assertTrue(expected is None)
+            returnValue((job, interval,))
+
+        job, interval = yield inTransaction(dbpool.connection, _next)
+        self.assertEqual(job.priority, WORK_PRIORITY_HIGH)
+        self.assertEqual(interval, 2.0)
+
+        # The first job is no longer available, so the next one is returned
+        job, interval = yield inTransaction(dbpool.connection, _next)
+        self.assertEqual(job.priority, WORK_PRIORITY_LOW)
+        self.assertEqual(interval, 1.0)
+
+        job, interval = yield inTransaction(dbpool.connection, _next)
+        self.assertTrue(job is None)
+        self.assertEqual(interval, 1.5)
+        self.assertEqual((pollState.hits, pollState.misses), (2, 1))
+
+    @inlineCallbacks
+    def test_nextjobPrefetch(self):
+        """
+        L{JobItem.nextjob} hands out jobs fetched by an earlier call in the same
+        transaction, but not ones that have since been assigned, and only keeps a
+        queue on the transaction when it fetched extra jobs.
+        """
+
+        self.patch(JobItem, "prefetchBatch", 2)
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        now = datetime.datetime.utcnow()
+        yield self._enqueue(dbpool, 1, 1, now + datetime.timedelta(days=-1), priority=WORK_PRIORITY_HIGH)
+        yield self._enqueue(dbpool, 2, 1, now + datetime.timedelta(days=-1))
+
+        @inlineCallbacks
+        def _next(txn):
+            job1 = yield JobItem.nextjob(txn, now, WORK_PRIORITY_LOW, 1)
+            self.assertEqual(len(JobItem._prefetched(txn)), 1)
+            job2 = yield JobItem.nextjob(txn, now, WORK_PRIORITY_LOW, 1)
+            self.assertEqual(len(JobItem._prefetched(txn)), 0)
+            returnValue((job1, job2))
+        job1, job2 = yield inTransaction(dbpool.connection, _next)
+        self.assertEqual(job1.priority, WORK_PRIORITY_HIGH)
+        self.assertEqual(job2.priority, WORK_PRIORITY_LOW)
+
+        @inlineCallbacks
+        def _assignedNotReturned(txn):
+            job1 = yield JobItem.nextjob(txn, now, WORK_PRIORITY_LOW, 1)
+            yield job1.assign(now, ControllerQueue.queueOverdueTimeout)
+            job2 = JobItem._prefetched(txn)[0]
+            yield job2.assign(now, ControllerQueue.queueOverdueTimeout)
+            job3 = yield JobItem.nextjob(txn, now, WORK_PRIORITY_LOW, 1)
+            returnValue(job3)
+        job3 = yield inTransaction(dbpool.connection, _assignedNotReturned)
+        self.assertTrue(job3 is None)
+
+        # Nothing is kept on the transaction when there are no extra jobs
+        self.patch(JobItem, "prefetchBatch", 1)
+        yield self._enqueue(dbpool, 3, 1, now + datetime.timedelta(days=-1))
+
+        @inlineCallbacks
+        def _noExtras(txn):
+            job = yield JobItem.nextjob(txn, now, WORK_PRIORITY_LOW, 1)
+            self.assertTrue(getattr(txn, "_jobPrefetch", None) is None)
+            returnValue(job)
+        job = yield inTransaction(dbpool.connection, _noExtras)
+        self.assertTrue(job is not None)
+
+    @inlineCallbacks
+    def test_nextjobLifo(self):
+        """
+        L{JobItem.nextjob} returns the newest job of a C{lifoEligible} work type
+        first when more than L{JobItem.starvationThreshold} jobs are ready, still
+        taking higher priority jobs before lower priority ones.
+        """
+
+        self.patch(JobItem, "_lifoWorkTypes", [DummyWorkItem.workType()])
+        self.patch(JobItem, "_starvationCheck", (None, False))
+        self.patch(JobItem, "starvationCheckInterval", 0)
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        now = datetime.datetime.utcnow()
+        yield self._enqueue(dbpool, 1, 1, now + datetime.timedelta(days=-3), priority=WORK_PRIORITY_HIGH)
+        yield self._enqueue(dbpool, 2, 1, now + datetime.timedelta(days=-1), priority=WORK_PRIORITY_LOW)
+        yield self._enqueue(dbpool, 3, 1, now + datetime.timedelta(days=-2), priority=WORK_PRIORITY_HIGH)
+
+        @inlineCallbacks
+        def _next(txn):
+            job = yield JobItem.nextjob(txn, now, WORK_PRIORITY_LOW, 1)
+            yield job.assign(now, ControllerQueue.queueOverdueTimeout)
+            work = yield job.workItem()
+            returnValue(work.a)
+
+        self.patch(JobItem, "starvationThreshold", 3)
+        starved = yield inTransaction(dbpool.connection, JobItem.starved, now=now)
+        self.assertFalse(starved)
+
+        self.patch(JobItem, "starvationThreshold", 0)
+        starved = yield inTransaction(dbpool.connection, JobItem.starved, now=now)
+        self.assertTrue(starved)
+
+        order = []
+        for _ignore in range(3):
+            order.append((yield inTransaction(dbpool.connection, _next)))
+        self.assertEqual(order, [3, 1, 2])
+
+    def test_sampleStarved(self):
+        """
+        L{JobItem.nextjob} only re-checks L{JobItem.starved} once
+        L{JobItem.starvationCheckInterval} has passed.
+        """
+
+        checks = []
+
+        def _starved(cls, txn, now):
+            checks.append(now)
+            return succeed(True)
+
+        self.patch(JobItem, "_lifoWorkTypes", [DummyWorkItem.workType()])
+        self.patch(JobItem, "_starvationCheck", (None, False))
+        self.patch(JobItem, "starvationThreshold", 0)
+        self.patch(JobItem, "starved", classmethod(_starved))
+
+        now = datetime.datetime.utcnow()
+        for seconds in (0, 1, 4, 5, 6):
+            result = []
+            JobItem._sampleStarved(None, now + datetime.timedelta(seconds=seconds)).addCallback(result.append)
+            self.assertEqual(result, [True])
+        self.assertEqual(checks, [now, now + datetime.timedelta(seconds=5)])
+
     @inlineCallbacks
     def test_notsingleton(self):
         """
@@ -15,10 +15,13 @@
 ##
 
 from datetime import datetime, timedelta
-from twext.enterprise.dal.record import SerializableRecord, NoSuchRecord
+from twext.enterprise.dal.record import SerializableRecord, NoSuchRecord, \
+    _RecordMeta
+from twext.enterprise.dal.syntax import Select, SavepointAction
 from twext.enterprise.jobs.jobitem import JobItem
 from twext.python.log import Logger
 from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+from twisted.python.failure import Failure
 
 log = Logger()
 
@@ -43,6 +46,18 @@ WORK_WEIGHT_10 = 10
 WORK_WEIGHT_CAPACITY = 10   # Total amount of work any one worker can manage
 
 
+class _WorkItemMeta(_RecordMeta):
+    """
+    Metaclass that registers each L{WorkItem} sub-class mapped to a table with
+    L{JobItem} as soon as it is defined.
+    """
+
+    def __init__(cls, name, bases, ns):
+        super(_WorkItemMeta, cls).__init__(name, bases, ns)
+        if getattr(cls, "table", None) is not None:
+            JobItem.registerWorkType(cls)
+
+
 class WorkItem(SerializableRecord):
     """
     A L{WorkItem} is an item of work which may be stored in a database, then
@@ -133,9 +148,17 @@ class WorkItem(SerializableRecord):
     @ivar group: If not C{None}, a unique-to-the-database identifier for which
         only one L{WorkItem} will execute at a time.
     @type group: L{unicode} or L{NoneType}
+
+    @cvar lifoEligible: whether jobs of this type may be run newest first when the
+        job queue is backed up (see L{JobItem.starvationThreshold}). Set this for
+        interactive work that should not wait behind a large backlog.
+    @type lifoEligible: L{bool}
     """
 
+    __metaclass__ = _WorkItemMeta
+
     group = None
+    lifoEligible = False
     default_priority = WORK_PRIORITY_LOW    # Default - subclasses should override
     default_weight = WORK_WEIGHT_5          # Default - subclasses should override
     _tableNameMap = {}
@@ -189,6 +212,115 @@ class WorkItem(SerializableRecord):
         workItems = yield cls.query(txn, (cls.jobID == jobID))
         returnValue(workItems)
 
+    @classmethod
+    @inlineCallbacks
+    def trylockForJob(cls, txn, jobID):
+        """
+        Try to lock the L{WorkItem} for a job with a select for update no wait,
+        without loading it first. If it fails, rollback to a savepoint and return
+        L{False}, else return L{True}. When the sub-class overrides L{loadForJob},
+        the L{WorkItem} it returns is loaded and locked with L{trylock} instead.
+
+        @param txn: the transaction to use
+        @type txn: L{IAsyncTransaction}
+        @param jobID: the job whose L{WorkItem} is to be locked
+        @type jobID: L{int}
+
+        @return: an L{Deferred} that fires with L{True} if the L{WorkItem} was locked
+            (or does not exist), L{False} if it is already locked.
+        @rtype: L{Deferred}
+        """
+        if cls.loadForJob.__func__ is not WorkItem.loadForJob.__func__:
+            workItems = yield cls.loadForJob(txn, jobID)
+            if len(workItems) != 1:
+                returnValue(True)
+            locked = yield workItems[0].trylock()
+            returnValue(locked)
+
+        savepoint = SavepointAction("WorkItem_trylockForJob_{}".format(cls.__name__))
+        yield savepoint.acquire(txn)
+        try:
+            yield Select(
+                [cls.jobID],
+                From=cls.table,
+                Where=(cls.jobID == jobID),
+                ForUpdate=True,
+                NoWait=True,
+            ).on(txn)
+        except:
+            log.debug(
+                "trylockForJob failed: {cls} {jobID}",
+                cls=cls.__name__,
+                jobID=jobID,
+            )
+            yield savepoint.rollback(txn)
+            returnValue(False)
+        else:
+            yield savepoint.release(txn)
+            returnValue(True)
+
+    @classmethod
+    @inlineCallbacks
+    def loadAndLockForJob(cls, txn, jobID):
+        """
+        Load the L{WorkItem} for a job and lock it via L{runlock}. When the
+        sub-class uses the default L{loadForJob} and L{runlock} with no C{group},
+        this is done with a single select for update no wait, rolling back to a
+        savepoint if the lock fails. Otherwise the L{WorkItem} is loaded and then
+        locked by its own L{runlock}, so that any group locks are taken in the
+        right order. Errors other than a failure to get the lock are raised.
+
+        @param txn: the transaction to use
+        @type txn: L{IAsyncTransaction}
+        @param jobID: the job whose L{WorkItem} is to be loaded
+        @type jobID: L{int}
+
+        @return: an L{Deferred} that fires with a L{tuple} of the L{WorkItem} (or
+            L{None} if there is not exactly one for the job), and L{True} if it was
+            locked (or does not exist), L{False} if it is already locked.
+        @rtype: L{Deferred}
+        """
+        if (
+            cls.group is not None or
+            cls.runlock.__func__ is not WorkItem.runlock.__func__ or
+            cls.loadForJob.__func__ is not WorkItem.loadForJob.__func__
+        ):
+            workItems = yield cls.loadForJob(txn, jobID)
+            workItem = workItems[0] if len(workItems) == 1 else None
+            locked = True
+            if workItem is not None:
+                locked = yield workItem.runlock()
+            returnValue((workItem, locked,))
+
+        savepoint = SavepointAction("WorkItem_loadAndLockForJob_{}".format(cls.__name__))
+        yield savepoint.acquire(txn)
+        try:
+            workItems = yield cls._rowsFromQuery(
+                txn,
+                cls.queryExpr((cls.jobID == jobID), forUpdate=True, noWait=True),
+                None,
+            )
+        except:
+            f = Failure()
+            yield savepoint.rollback(txn)
+
+            # Only a failure to get the row lock means the L{WorkItem} is already
+            # being worked on. Anything else (e.g. a bad query or a lost connection)
+            # must be reported as an error, so check that the row can be loaded
+            # without the lock - if it can't, or is not there to be locked, re-raise.
+            workItems = yield cls.query(txn, (cls.jobID == jobID))
+            if not workItems:
+                f.raiseException()
+            log.debug(
+                "loadAndLockForJob failed: {cls} {jobID}",
+                cls=cls.__name__,
+                jobID=jobID,
+            )
+            returnValue((workItems[0] if len(workItems) == 1 else None, False,))
+        else:
+            yield savepoint.release(txn)
+            returnValue((workItems[0] if len(workItems) == 1 else None, True,))
+
     @classmethod
     def updateWorkTypes(cls, updates):
         """
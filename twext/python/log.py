@@ -17,7 +17,7 @@
 
 from twisted.logger import Logger as _Logger, LogLevel, LogPublisher, \
     FileLogObserver, FilteringLogObserver, LogLevelFilterPredicate, \
-    formatEventAsClassicLogText, formatTime
+    PredicateResult, formatEventAsClassicLogText, formatTime
 from twisted.python import log
 from twisted import logger
 
@@ -88,6 +88,23 @@ class Logger(_Logger):
         """
         return self.filterPredicate
 
+    def isEnabledFor(self, level):
+        """
+        Determine whether events at the given level from this logger will pass the
+        level filter. Use this to avoid computing the arguments for log events that
+        would be discarded, e.g. debug events on a busy code path.
+
+        @param level: the log level
+        @type level: L{LogLevel}
+
+        @return: L{True} if events at C{level} are logged
+        @rtype: L{bool}
+        """
+        return self.filterPredicate({
+            "log_level": level,
+            "log_namespace": self.namespace,
+        }) != PredicateResult.no
+
 
 # Always replace Twisted's legacy log beginner with one that does LogLevel filtering
 class FilteringLogBeginnerWrapper(object):
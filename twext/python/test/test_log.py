@@ -94,3 +94,16 @@ class LogPublisherTests(unittest.TestCase):
         self.assertEqual(observed[index]["log_format"], u"T\xe9st {str}")
         self.assertEqual(observed[index]["str"], u"t\xe9st")
         self.assertEqual(sio.getvalue().splitlines()[index].split("#info] ")[1], "T\xc3\xa9st t\xc3\xa9st")
+
+    def test_isEnabledFor(self):
+        """
+        L{Logger.isEnabledFor} reflects the log level configured for the
+        logger's namespace.
+        """
+        logger = Logger(namespace="twext.python.test.test_log.isEnabledFor")
+        self.assertTrue(logger.isEnabledFor(LogLevel.info))
+        self.assertFalse(logger.isEnabledFor(LogLevel.debug))
+
+        logger.levels().setLogLevelForNamespace(logger.namespace, LogLevel.debug)
+        self.addCleanup(logger.levels().setLogLevelForNamespace, logger.namespace, LogLevel.info)
+        self.assertTrue(logger.isEnabledFor(LogLevel.debug))
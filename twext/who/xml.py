@@ -30,10 +30,16 @@ __all__ = [
 from time import time
 from uuid import UUID
 
-from xml.etree.ElementTree import (
-    parse as parseXML, ParseError as XMLParseError,
-    tostring as etreeToString, Element as XMLElement,
-)
+try:
+    from xml.etree.cElementTree import (
+        parse as parseXML, ParseError as XMLParseError,
+        tostring as etreeToString, Element as XMLElement,
+    )
+except ImportError:
+    from xml.etree.ElementTree import (
+        parse as parseXML, ParseError as XMLParseError,
+        tostring as etreeToString, Element as XMLElement,
+    )
 
 from twisted.python.constants import Names, Values, ValueConstant, Flags
 from twisted.internet.defer import fail